@@ -1,18 +1,50 @@
-from enum import Enum
+import asyncio
+import hmac
+import sys
+import threading
+import time
+from functools import wraps
+from collections import deque
+from enum import Enum, IntEnum
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 class TransactionType(Enum):
     BALANCE_INQUIRY = "balance_inquiry"
     WITHDRAWAL = "withdrawal"
     DEPOSIT = "deposit"
 
-class ATMState(Enum):
-    IDLE = "idle"
-    CARD_INSERTED = "card_inserted"
-    PIN_VERIFIED = "pin_verified"
-    ACCOUNT_SELECTED = "account_selected"
-    TRANSACTION_COMPLETED = "transaction_completed"
+class ATMState(IntEnum):
+    # Ordered so that session progress can be checked with a single compare
+    IDLE = 0
+    CARD_INSERTED = 1
+    PIN_VERIFIED = 2
+    ACCOUNT_SELECTED = 3
+    TRANSACTION_COMPLETED = 4
+
+# Module-level aliases so hot controller paths skip enum attribute resolution
+_IDLE = ATMState.IDLE
+_CARD_INSERTED = ATMState.CARD_INSERTED
+_PIN_VERIFIED = ATMState.PIN_VERIFIED
+_ACCOUNT_SELECTED = ATMState.ACCOUNT_SELECTED
+_TX_BALANCE_INQUIRY = TransactionType.BALANCE_INQUIRY
+_TX_WITHDRAWAL = TransactionType.WITHDRAWAL
+_TX_DEPOSIT = TransactionType.DEPOSIT
+
+# Default number of transaction records kept in memory by the controller
+_HISTORY_MAX = 1024
+# Default number of buffered records before flushing to the history sink
+_FLUSH_THRESHOLD = 10_000
+# Default seconds a cached account balance is trusted before refetching;
+# 0 disables the cache so every inquiry reads the bank
+_BALANCE_TTL = 0.0
+
+class TxRecord(NamedTuple):
+    """Single entry in the controller's transaction history"""
+    type: TransactionType
+    account: str
+    amount: int
+    success: bool
 
 class BankSystemInterface(ABC):
     """Interface for bank system integration"""
@@ -33,13 +65,18 @@ class BankSystemInterface(ABC):
         pass
     
     @abstractmethod
-    def withdraw(self, account_number: str, amount: int) -> bool:
-        """Withdraw amount from account, returns success status"""
+    def get_balances(self, account_numbers: List[str]) -> Dict[str, int]:
+        """Get current balances for several accounts in one call"""
         pass
     
     @abstractmethod
-    def deposit(self, account_number: str, amount: int) -> bool:
-        """Deposit amount to account, returns success status"""
+    def withdraw(self, account_number: str, amount: int) -> Tuple[bool, Optional[int]]:
+        """Withdraw amount from account, returns success status and new balance"""
+        pass
+    
+    @abstractmethod
+    def deposit(self, account_number: str, amount: int) -> Tuple[bool, Optional[int]]:
+        """Deposit amount to account, returns success status and new balance"""
         pass
 
 class HardwareInterface(ABC):
@@ -65,11 +102,19 @@ class HardwareInterface(ABC):
         """Accept cash deposit, returns amount accepted"""
         pass
 
+class HistorySink(ABC):
+    """Interface for durable storage of transaction history"""
+    
+    @abstractmethod
+    def flush(self, records: List[TxRecord]) -> None:
+        """Persist a batch of transaction records"""
+        pass
+
 class MockBankSystem(BankSystemInterface):
     """Mock implementation of bank system for testing"""
     
-    def __init__(self):
-        self.accounts = {
+    def __init__(self) -> None:
+        self.accounts: Dict[str, Dict[str, Any]] = {
             "1234567890": {  # card number
                 "pin": "1234",
                 "accounts": [
@@ -84,46 +129,65 @@ class MockBankSystem(BankSystemInterface):
                 ]
             }
         }
+        # Flat index of account number -> account record for O(1) lookups
+        self._by_number: Dict[str, Dict[str, Any]] = {
+            sys.intern(account["number"]): account
+            for card_data in self.accounts.values()
+            for account in card_data["accounts"]
+        }
+        # Per-account locks guarding balance read-modify-write
+        self._locks: Dict[str, threading.Lock] = {
+            number: threading.Lock()
+            for number in self._by_number
+        }
     
     def verify_pin(self, card_number: str, pin: str) -> bool:
-        if card_number in self.accounts:
-            return self.accounts[card_number]["pin"] == pin
-        return False
+        if not isinstance(pin, str):
+            return False
+        
+        # Always run the constant-time compare so a known and unknown card
+        # take the same path; an empty stored PIN never matches a real one
+        stored_pin = self.accounts.get(card_number, {}).get("pin", "")
+        matches = hmac.compare_digest(stored_pin.encode(), pin.encode())
+        return matches and bool(stored_pin)
     
     def get_accounts(self, card_number: str) -> List[Dict]:
-        if card_number in self.accounts:
-            return self.accounts[card_number]["accounts"]
-        return []
+        card_data = self.accounts.get(card_number)
+        return card_data["accounts"] if card_data else []
     
     def get_balance(self, account_number: str) -> int:
-        for card_data in self.accounts.values():
-            for account in card_data["accounts"]:
-                if account["number"] == account_number:
-                    return account["balance"]
-        return 0
+        return self._by_number.get(account_number, {}).get("balance", 0)
     
-    def withdraw(self, account_number: str, amount: int) -> bool:
+    def get_balances(self, account_numbers: List[str]) -> Dict[str, int]:
+        return {
+            number: self._by_number[number]["balance"]
+            for number in account_numbers
+            if number in self._by_number
+        }
+    
+    def withdraw(self, account_number: str, amount: int) -> Tuple[bool, Optional[int]]:
         if amount <= 0:
-            return False
-            
-        for card_data in self.accounts.values():
-            for account in card_data["accounts"]:
-                if account["number"] == account_number:
-                    if account["balance"] >= amount:
-                        account["balance"] -= amount
-                        return True
-        return False
+            return False, None
+        
+        account = self._by_number.get(account_number)
+        if account is None:
+            return False, None
+        with self._locks[account_number]:
+            if account["balance"] < amount:
+                return False, None
+            account["balance"] -= amount
+            return True, account["balance"]
     
-    def deposit(self, account_number: str, amount: int) -> bool:
+    def deposit(self, account_number: str, amount: int) -> Tuple[bool, Optional[int]]:
         if amount <= 0:
-            return False
-            
-        for card_data in self.accounts.values():
-            for account in card_data["accounts"]:
-                if account["number"] == account_number:
-                    account["balance"] += amount
-                    return True
-        return False
+            return False, None
+        
+        account = self._by_number.get(account_number)
+        if account is None:
+            return False, None
+        with self._locks[account_number]:
+            account["balance"] += amount
+            return True, account["balance"]
 
 class MockHardware(HardwareInterface):
     """Mock implementation of ATM hardware for testing"""
@@ -150,79 +214,131 @@ class MockHardware(HardwareInterface):
         # Simulate accepting $100 for testing
         return 100
 
+def requires_state(state: ATMState, fail: Any = False, at_least: bool = False):
+    """Run the method only in `state` (or any later one with `at_least`), else return `fail`"""
+    def decorator(method):
+        if at_least:
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                with self._lock:
+                    if self.state < state:
+                        return fail
+                    return method(self, *args, **kwargs)
+        else:
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                with self._lock:
+                    if self.state != state:
+                        return fail
+                    return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class ATMController:
     """Main ATM controller that handles the ATM workflow"""
     
-    def __init__(self, bank_system: BankSystemInterface, hardware: HardwareInterface):
+    def __init__(self, bank_system: BankSystemInterface, hardware: HardwareInterface,
+                 history_max: int = _HISTORY_MAX,
+                 history_sink: Optional[HistorySink] = None,
+                 flush_threshold: int = _FLUSH_THRESHOLD,
+                 balance_ttl: float = _BALANCE_TTL):
         self.bank_system = bank_system
         self.hardware = hardware
-        self.state = ATMState.IDLE
+        # Serializes session state changes; withdraw_async/deposit_async run
+        # transactions on executor threads
+        self._lock = threading.Lock()
+        self.state = _IDLE
         self.current_card = None
+        # Invariant: selected_account is set iff state >= ACCOUNT_SELECTED
         self.selected_account = None
-        self.transaction_history = []
+        self._cached_accounts = None
+        self._cached_account_by_number: Dict[str, Dict] = {}
+        # Bounded so long-running sessions don't grow memory; oldest roll off
+        self.transaction_history = deque(maxlen=history_max)
+        self.history_sink = history_sink
+        self.flush_threshold = flush_threshold
+        self._history_buffer: List[TxRecord] = []
+        # Last known balance per account as (balance, monotonic timestamp)
+        self.balance_ttl = balance_ttl
+        self._balance_cache: Dict[str, Tuple[int, float]] = {}
     
     def insert_card(self, card_number: str) -> bool:
         """Simulate card insertion"""
-        if self.state != ATMState.IDLE:
+        if not card_number or not isinstance(card_number, str):
             return False
         
-        self.current_card = card_number
-        self.state = ATMState.CARD_INSERTED
-        return True
+        with self._lock:
+            if self.state != _IDLE:
+                return False
+            
+            # Interned so later dict lookups on the card number hit the identity fast path
+            self.current_card = sys.intern(card_number)
+            self.state = _CARD_INSERTED
+            return True
     
+    @requires_state(_CARD_INSERTED)
     def enter_pin(self, pin: str) -> bool:
         """Verify PIN number"""
-        if self.state != ATMState.CARD_INSERTED or not self.current_card:
+        if not self.current_card:
             return False
         
         if self.bank_system.verify_pin(self.current_card, pin):
-            self.state = ATMState.PIN_VERIFIED
+            # Fetch accounts once per session; select_account reads from here
+            self._cached_accounts = self.bank_system.get_accounts(self.current_card)
+            self._cached_account_by_number = {
+                sys.intern(account["number"]): account
+                for account in self._cached_accounts
+            }
+            self.state = _PIN_VERIFIED
             return True
         return False
     
     def get_available_accounts(self) -> List[Dict]:
         """Get list of available accounts for current card"""
-        if self.state != ATMState.PIN_VERIFIED or not self.current_card:
+        if self.state != _PIN_VERIFIED or not self.current_card:
             return []
         
-        return self.bank_system.get_accounts(self.current_card)
+        return self._cached_accounts or []
+    
+    def get_all_balances(self) -> Dict[str, int]:
+        """Get balances of every account on the current card in one request"""
+        if not self._cached_accounts:
+            return {}
+        
+        return self.bank_system.get_balances(list(self._cached_account_by_number))
     
+    @requires_state(_PIN_VERIFIED)
     def select_account(self, account_number: str) -> bool:
         """Select an account for transactions"""
-        if self.state != ATMState.PIN_VERIFIED:
+        if not account_number or not isinstance(account_number, str):
             return False
         
-        accounts = self.get_available_accounts()
-        for account in accounts:
-            if account["number"] == account_number:
-                self.selected_account = account_number
-                self.state = ATMState.ACCOUNT_SELECTED
-                return True
+        account_number = sys.intern(account_number)
+        if account_number in self._cached_account_by_number:
+            self.selected_account = account_number
+            self.state = _ACCOUNT_SELECTED
+            return True
         return False
     
+    @requires_state(_ACCOUNT_SELECTED, fail=None, at_least=True)
     def check_balance(self) -> Optional[int]:
         """Check balance of selected account"""
-        if self.state != ATMState.ACCOUNT_SELECTED or not self.selected_account:
-            return None
-        
-        balance = self.bank_system.get_balance(self.selected_account)
-        self.transaction_history.append({
-            "type": TransactionType.BALANCE_INQUIRY,
-            "account": self.selected_account,
-            "amount": 0,
-            "success": True
-        })
+        cached = self._balance_cache.get(self.selected_account)
+        if cached is not None and time.monotonic() - cached[1] < self.balance_ttl:
+            balance = cached[0]
+        else:
+            balance = self.bank_system.get_balance(self.selected_account)
+            self._cache_balance(balance)
+        self._record(_TX_BALANCE_INQUIRY, 0, True)
         return balance
     
+    @requires_state(_ACCOUNT_SELECTED, fail=(False, None), at_least=True)
     def withdraw(self, amount: int) -> Tuple[bool, Optional[int]]:
         """Withdraw money from selected account"""
-        if self.state != ATMState.ACCOUNT_SELECTED or not self.selected_account:
-            return False, None
-        
         if amount <= 0:
             return False, None
         
-        success = self.bank_system.withdraw(self.selected_account, amount)
+        success, new_balance = self.bank_system.withdraw(self.selected_account, amount)
         if success:
             # Try to dispense cash
             cash_success = self.hardware.dispense_cash(amount)
@@ -231,59 +347,88 @@ class ATMController:
                 self.bank_system.deposit(self.selected_account, amount)
                 success = False
         
-        self.transaction_history.append({
-            "type": TransactionType.WITHDRAWAL,
-            "account": self.selected_account,
-            "amount": amount,
-            "success": success
-        })
+        self._record(_TX_WITHDRAWAL, amount, success)
         
         if success:
-            new_balance = self.bank_system.get_balance(self.selected_account)
+            self._cache_balance(new_balance)
             return True, new_balance
+        self._balance_cache.pop(self.selected_account, None)
         return False, None
     
+    @requires_state(_ACCOUNT_SELECTED, fail=(False, None), at_least=True)
     def deposit(self, amount: int) -> Tuple[bool, Optional[int]]:
         """Deposit money to selected account"""
-        if self.state != ATMState.ACCOUNT_SELECTED or not self.selected_account:
+        if amount <= 0:
             return False, None
         
+        # Accept cash from hardware; the accepted amount is what gets credited
+        amount = self.hardware.accept_cash()
         if amount <= 0:
+            self._record(_TX_DEPOSIT, amount, False)
             return False, None
         
-        # Accept cash from hardware
-        accepted_amount = self.hardware.accept_cash()
-        if accepted_amount != amount:
-            # For simplicity, we'll use the accepted amount
-            amount = accepted_amount
-        
-        success = self.bank_system.deposit(self.selected_account, amount)
+        success, new_balance = self.bank_system.deposit(self.selected_account, amount)
         
-        self.transaction_history.append({
-            "type": TransactionType.DEPOSIT,
-            "account": self.selected_account,
-            "amount": amount,
-            "success": success
-        })
+        self._record(_TX_DEPOSIT, amount, success)
         
         if success:
-            new_balance = self.bank_system.get_balance(self.selected_account)
+            self._cache_balance(new_balance)
             return True, new_balance
         return False, None
     
+    async def withdraw_async(self, amount: int) -> Tuple[bool, Optional[int]]:
+        """Withdraw without blocking the event loop on bank or hardware I/O"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.withdraw, amount)
+    
+    async def deposit_async(self, amount: int) -> Tuple[bool, Optional[int]]:
+        """Deposit without blocking the event loop on bank or hardware I/O"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.deposit, amount)
+    
     def eject_card(self) -> bool:
         """Eject card and reset state"""
-        success = self.hardware.eject_card()
-        if success:
-            self._reset_state()
-        return success
+        # Waits for an in-flight transaction so it never sees a half-reset session
+        with self._lock:
+            success = self.hardware.eject_card()
+            if success:
+                self._flush_history()
+                self._reset_state()
+            return success
     
     def cancel_transaction(self) -> bool:
         """Cancel current transaction and eject card"""
         return self.eject_card()
     
+    def _cache_balance(self, balance: int):
+        """Remember the latest known balance of the selected account"""
+        self._balance_cache[self.selected_account] = (balance, time.monotonic())
+    
+    def _record(self, tx_type: TransactionType, amount: int, success: bool):
+        """Record a transaction, flushing to the sink once the buffer fills"""
+        record = TxRecord(tx_type, self.selected_account, amount, success)
+        self.transaction_history.append(record)
+        if self.history_sink is None:
+            return
+        
+        self._history_buffer.append(record)
+        if len(self._history_buffer) >= self.flush_threshold:
+            self._flush_history()
+    
+    def _flush_history(self):
+        """Write buffered records to the history sink in one batch"""
+        if self.history_sink is None or not self._history_buffer:
+            return
+        
+        self.history_sink.flush(self._history_buffer)
+        self._history_buffer = []
+    
     def _reset_state(self):
         """Reset controller state"""
-        self.state = ATMState.IDLE
+        # Clear together with state to keep the selected_account invariant
+        self.state = _IDLE
         self.current_card = None
-        self.selected_account = None
\ No newline at end of file
+        self.selected_account = None
+        self._cached_accounts = None
+        self._cached_account_by_number = {}
+        self._balance_cache.clear()
\ No newline at end of file
@@ -1,9 +1,22 @@
+import asyncio
+
 from atm_controller import (
     MockBankSystem,
     MockHardware,
-    ATMController
+    ATMController,
+    HistorySink,
+    TransactionType
 )
 
+class ListHistorySink(HistorySink):
+    """History sink that collects flushed batches in memory"""
+    
+    def __init__(self):
+        self.batches = []
+    
+    def flush(self, records):
+        self.batches.append(list(records))
+
 # Test cases
 def test_atm_controller():
     """Test the ATM controller functionality"""
@@ -19,6 +32,7 @@ def test_atm_controller():
     assert atm.enter_pin("1234")
     accounts = atm.get_available_accounts()
     assert len(accounts) == 2
+    assert atm.get_all_balances() == {"1001": 1000, "1002": 5000}
     assert atm.select_account("1001")
     balance = atm.check_balance()
     assert balance == 1000
@@ -33,6 +47,7 @@ def test_atm_controller():
     success, new_balance = atm.withdraw(100)
     assert success
     assert new_balance == 900
+    assert atm.check_balance() == 900
     assert atm.eject_card()
     print("✓ Test 2 passed\n")
     
@@ -62,6 +77,7 @@ def test_atm_controller():
     print("Test 5: Invalid PIN")
     assert atm.insert_card("1234567890")
     assert not atm.enter_pin("wrong")
+    assert not atm.enter_pin(1234)
     # Should still be able to eject card even with wrong PIN
     assert atm.eject_card()
     print("✓ Test 5 passed\n")
@@ -72,9 +88,131 @@ def test_atm_controller():
     assert not atm.enter_pin("1234")
     # Try to select account without card
     assert not atm.select_account("1001")
+    # Reading an empty card slot yields None, which must be rejected cleanly
+    assert not atm.insert_card(None)
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert not atm.select_account(1001)
+    assert atm.eject_card()
     print("✓ Test 6 passed\n")
     
     print("All tests passed!")
 
+class EmptyCashHardware(MockHardware):
+    """Hardware whose cash acceptor never takes any notes"""
+    
+    def accept_cash(self):
+        return 0
+
+def test_history_sink():
+    """Test that history is flushed at the threshold and on card ejection"""
+    
+    sink = ListHistorySink()
+    atm = ATMController(MockBankSystem(), MockHardware(),
+                        history_sink=sink, flush_threshold=2)
+    
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    atm.check_balance()
+    assert sink.batches == []
+    atm.withdraw(100)
+    assert len(sink.batches) == 1 and len(sink.batches[0]) == 2
+    atm.deposit(100)
+    assert atm.eject_card()
+    assert len(sink.batches) == 2 and len(sink.batches[1]) == 1
+    print("✓ History sink test passed\n")
+
+def test_async_transactions():
+    """Test the non-blocking withdraw/deposit variants"""
+    
+    atm = ATMController(MockBankSystem(), MockHardware())
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    assert asyncio.run(atm.withdraw_async(100)) == (True, 900)
+    assert asyncio.run(atm.deposit_async(100)) == (True, 1000)
+    assert atm.eject_card()
+    assert asyncio.run(atm.withdraw_async(100)) == (False, None)
+    
+    # Concurrent transactions on one controller are serialized
+    bank_system = MockBankSystem()
+    atm = ATMController(bank_system, MockHardware())
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    
+    async def run_concurrently():
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            atm.withdraw_async(100),
+            atm.withdraw_async(100),
+            atm.deposit_async(100),
+            loop.run_in_executor(None, atm.eject_card),
+        )
+    
+    results = asyncio.run(run_concurrently())
+    assert results[-1]
+    assert atm.selected_account is None
+    assert all(record.account == "1001" for record in atm.transaction_history)
+    expected = 1000 + sum(
+        record.amount if record.type is TransactionType.DEPOSIT else -record.amount
+        for record in atm.transaction_history if record.success
+    )
+    assert bank_system.get_balance("1001") == expected
+    print("✓ Async transactions test passed\n")
+
+def test_balance_cache():
+    """Test that check_balance serves cached balances only when enabled"""
+    
+    # With a TTL, a write made behind the controller's back is not seen
+    bank_system = MockBankSystem()
+    atm = ATMController(bank_system, MockHardware(), balance_ttl=60)
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    assert atm.check_balance() == 1000
+    assert bank_system.withdraw("1001", 500) == (True, 500)
+    assert atm.check_balance() == 1000
+    
+    # A new session starts with an empty cache
+    assert atm.eject_card()
+    assert atm._balance_cache == {}
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    assert atm.check_balance() == 500
+    assert atm.eject_card()
+    
+    # The default TTL of 0 always reads the bank
+    bank_system = MockBankSystem()
+    atm = ATMController(bank_system, MockHardware())
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    assert atm.check_balance() == 1000
+    assert bank_system.withdraw("1001", 500) == (True, 500)
+    assert atm.check_balance() == 500
+    assert atm.eject_card()
+    print("✓ Balance cache test passed\n")
+
+def test_deposit_without_cash():
+    """Test that a deposit with no accepted cash fails and is still recorded"""
+    
+    atm = ATMController(MockBankSystem(), EmptyCashHardware())
+    assert atm.insert_card("1234567890")
+    assert atm.enter_pin("1234")
+    assert atm.select_account("1001")
+    assert atm.deposit(100) == (False, None)
+    assert len(atm.transaction_history) == 1
+    record = atm.transaction_history[0]
+    assert record.type is TransactionType.DEPOSIT and not record.success
+    assert atm.eject_card()
+    print("✓ Deposit without cash test passed\n")
+
 if __name__ == "__main__":
-    test_atm_controller()
\ No newline at end of file
+    test_atm_controller()
+    test_history_sink()
+    test_async_transactions()
+    test_balance_cache()
+    test_deposit_without_cash()
\ No newline at end of file